@@ -23,7 +23,6 @@ https://github.com/amoffat/sh
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 # ===============================================================================
-import asyncio
 from collections import deque
 from collections.abc import Mapping
 
@@ -43,7 +42,6 @@ if "windows" in platform.system().lower():  # pragma: no cover
 import errno
 import fcntl
 import gc
-import getpass
 import glob as glob_module
 import inspect
 import logging
@@ -52,6 +50,7 @@ import pty
 import pwd
 import re
 import select
+import selectors
 import signal
 import stat
 import struct
@@ -64,16 +63,15 @@ import traceback
 import tty
 import warnings
 import weakref
-from asyncio import Queue as AQueue
 from contextlib import contextmanager
-from functools import partial
+from functools import lru_cache, partial
 from io import BytesIO, StringIO, UnsupportedOperation
 from io import open as fdopen
 from locale import getpreferredencoding
 from queue import Empty, Queue
 from shlex import quote as shlex_quote
 from types import GeneratorType, ModuleType
-from typing import Any, Dict, Type, Union
+from typing import Any, Dict, Optional, Tuple, Type, Union
 
 __project_url__ = "https://github.com/amoffat/sh"
 
@@ -99,6 +97,20 @@ FORCE_USE_SELECT = bool(int(os.environ.get("SH_TESTS_USE_SELECT", "0")))
 PUSHD_LOCK = threading.RLock()
 
 
+def get_running_loop():
+    """returns the running asyncio event loop, or None if there isn't one.  most
+    people never use sh with asyncio, and asyncio is by far the most expensive
+    thing for us to import, so we don't import it ourselves.  if nothing else
+    has imported it, there can't be a loop running"""
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return None
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
 def get_num_args(fn):
     return len(inspect.getfullargspec(fn).args)
 
@@ -106,6 +118,12 @@ def get_num_args(fn):
 _unicode_methods = set(dir(""))
 
 HAS_POLL = hasattr(select, "poll")
+# linux 5.3+ can give us an fd that becomes readable when a process exits
+HAS_PIDFD = hasattr(os, "pidfd_open")
+# how many buffers we can hand to a single os.writev().  posix only promises 16
+IOV_MAX = 16
+if "SC_IOV_MAX" in os.sysconf_names:
+    IOV_MAX = max(os.sysconf("SC_IOV_MAX"), IOV_MAX)
 POLLER_EVENT_READ = 1
 POLLER_EVENT_WRITE = 2
 POLLER_EVENT_HUP = 4
@@ -119,12 +137,13 @@ class PollPoller:
         self.fd_lookup = {}
         self.fo_lookup = {}
 
-    def __nonzero__(self):
-        return len(self.fd_lookup) != 0
-
     def __len__(self):
         return len(self.fd_lookup)
 
+    def close(self):
+        # a poll object doesn't hold an fd, so there's nothing to release
+        pass
+
     def _set_fileobject(self, f):
         if hasattr(f, "fileno"):
             fd = f.fileno()
@@ -194,12 +213,12 @@ class SelectPoller:
         self.wlist = []
         self.xlist = []
 
-    def __nonzero__(self):
-        return len(self.rlist) + len(self.wlist) + len(self.xlist) != 0
-
     def __len__(self):
         return len(self.rlist) + len(self.wlist) + len(self.xlist)
 
+    def close(self):
+        pass
+
     @staticmethod
     def _register(f, events):
         if f not in events:
@@ -236,14 +255,67 @@ class SelectPoller:
         return results
 
 
+class SelectorPoller:
+    """for platforms without select.poll.  this uses the best selector that the
+    platform has instead (kqueue, for example), which, unlike select.select,
+    isn't limited to fds below 1024.  errors and hangups are reported by
+    selectors as the fd being readable"""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+    def __len__(self):
+        return len(self._selector.get_map())
+
+    def close(self):
+        # unlike the other pollers, our selector holds an fd (an epoll or kqueue
+        # instance), and it's in a reference cycle, so we can't leave closing it
+        # to refcounting
+        self._selector.close()
+
+    def _register(self, f, events):
+        try:
+            key = self._selector.get_key(f)
+        except KeyError:
+            self._selector.register(f, events)
+        else:
+            self._selector.modify(f, key.events | events)
+
+    def register_read(self, f):
+        self._register(f, selectors.EVENT_READ)
+
+    def register_write(self, f):
+        self._register(f, selectors.EVENT_WRITE)
+
+    def register_error(self, f):
+        self._register(f, selectors.EVENT_READ)
+
+    def unregister(self, f):
+        self._selector.unregister(f)
+
+    def poll(self, timeout):
+        results = []
+        for key, events in self._selector.select(timeout):
+            if events & selectors.EVENT_READ:
+                results.append((key.fileobj, POLLER_EVENT_READ))
+            elif events & selectors.EVENT_WRITE:
+                results.append((key.fileobj, POLLER_EVENT_WRITE))
+        return results
+
+
 # here we use an use a poller interface that transparently selects the most
 # capable poller (out of either select.select or select.poll).  this was added
 # by zhangyafeikimi when he discovered that if the fds created internally by sh
 # numbered > 1024, select.select failed (a limitation of select.select).  this
-# can happen if your script opens a lot of files
-Poller: Union[Type[SelectPoller], Type[PollPoller]] = SelectPoller
-if HAS_POLL and not FORCE_USE_SELECT:
-    Poller = PollPoller
+# can happen if your script opens a lot of files.  where there's no poll, we
+# still avoid that limit if the platform has a better selector than select()
+Poller: Union[Type[SelectPoller], Type[PollPoller], Type[SelectorPoller]]
+Poller = SelectPoller
+if not FORCE_USE_SELECT:
+    if HAS_POLL:
+        Poller = PollPoller
+    elif selectors.DefaultSelector is not selectors.SelectSelector:
+        Poller = SelectorPoller
 
 
 class ForkException(Exception):
@@ -367,7 +439,10 @@ class CommandNotFound(AttributeError):
 
 
 rc_exc_regex = re.compile(r"(ErrorReturnCode|SignalException)_((\d+)|SIG[a-zA-Z]+)")
-rc_exc_cache: Dict[str, Type[ErrorReturnCode]] = {}
+rc_exc_prefixes = ("ErrorReturnCode_", "SignalException_")
+# exception classes keyed on both their return code and the names they've been
+# looked up by, so that each one is only created (and each name only parsed) once
+rc_exc_cache: Dict[Union[int, str], Type[ErrorReturnCode]] = {}
 
 SIGNAL_MAPPING = {
     v: k for k, v in signal.__dict__.items() if re.match(r"SIG[a-zA-Z]+", k)
@@ -389,6 +464,11 @@ def get_exc_from_name(name):
     try:
         return rc_exc_cache[name]
     except KeyError:
+        # nearly every name that we're asked about is a program name, so a
+        # cheap prefix check spares those from the regex
+        if not name.startswith(rc_exc_prefixes):
+            return None
+
         m = rc_exc_regex.match(name)
         if m:
             base = m.group(1)
@@ -403,6 +483,7 @@ def get_exc_from_name(name):
                 rc = int(rc_or_sig_name)
 
             exc = get_rc_exc(rc)
+            rc_exc_cache[name] = exc
     return exc
 
 
@@ -431,6 +512,23 @@ def get_rc_exc(rc):
     return exc
 
 
+# build the exceptions for the most common failures up front, so that raising
+# them is just a cache hit.  signal deaths are negative exit codes here, not the
+# shell's 128+N
+for _rc in (
+    1,
+    2,
+    126,
+    127,
+    -signal.SIGINT,
+    -signal.SIGKILL,
+    -signal.SIGSEGV,
+    -signal.SIGTERM,
+):
+    get_rc_exc(_rc)
+del _rc
+
+
 # we monkey patch glob.  i'm normally generally against monkey patching, but i
 # decided to do this really un-intrusive patch because we need a way to detect
 # if a list that we pass into an sh command was generated from glob.  the reason
@@ -466,19 +564,119 @@ def canonicalize(path):
     return os.path.abspath(os.path.expanduser(path))
 
 
+# the locations that _which has found, keyed on the program name, the paths that
+# were searched and, when a relative name or relative PATH entries make the
+# lookup depend on it, our cwd (see _which_cache_key).  much like a shell's
+# command hash, we only remember programs that were found, so something that
+# gets installed later is still discovered, and a remembered location is
+# re-checked with a single stat before it's used
+_which_cache: Dict[Tuple[str, Union[str, Tuple[str, ...]], Optional[str]], str] = {}
+
+
+# the canonicalized directories for a search path, keyed on the PATH string (or
+# the tuple of search paths).  we only keep these when every directory is
+# already absolute, because then canonicalizing them doesn't depend on our cwd
+# or $HOME, and so the split and the abspath() calls can be done once per PATH
+_search_dirs_cache: Dict[Union[str, Tuple[str, ...]], Tuple[str, ...]] = {}
+
+
+def clear_which_cache():
+    """forgets every program location that we've remembered.  this is only
+    needed if a program has been installed *ahead* of the one we already found
+    on the search path, and it's the equivalent of "hash -r" in a shell"""
+    _which_cache.clear()
+    _search_dirs_cache.clear()
+
+
+def _search_dirs(search_key):
+    try:
+        return _search_dirs_cache[search_key]
+    except KeyError:
+        pass
+
+    if isinstance(search_key, tuple):
+        paths = search_key
+    else:
+        paths = search_key.split(os.pathsep)
+
+    # each directory keeps a trailing separator, so that a candidate is just the
+    # directory plus the program name
+    dirs = tuple(os.path.join(canonicalize(path), "") for path in paths)
+    if all(os.path.isabs(path) for path in paths):
+        _search_dirs_cache[search_key] = dirs
+    return dirs
+
+
+def _is_exe(file_path):
+    # a single stat tells us that the path exists and, because it follows
+    # symlinks, that it ends up at a regular file.  this saves us the separate
+    # exists() check and the realpath() walk over every component
+    try:
+        st = os.stat(file_path)
+    except (OSError, ValueError):
+        return False
+    return stat.S_ISREG(st.st_mode) and os.access(file_path, os.X_OK)
+
+
+def _which_cache_key(program, search_key):
+    """the key that we remember a lookup of program on search_key under.  our
+    cwd is only part of it if the lookup depends on it, meaning the program is a
+    relative path or something on the search path is.  otherwise a process that
+    moves through lots of directories would remember every lookup once for each
+    of them.  returns None if we need our cwd but it's gone"""
+    if os.path.dirname(program):
+        absolute = os.path.isabs(program)
+    else:
+        # _search_dirs only caches a search path if all of it is absolute
+        absolute = search_key in _search_dirs_cache
+        if not absolute:
+            _search_dirs(search_key)
+            absolute = search_key in _search_dirs_cache
+
+    if absolute:
+        return program, search_key, None
+
+    try:
+        return program, search_key, os.getcwd()
+    except OSError:
+        return None
+
+
 def _which(program, paths=None):
     """takes a program name or full path, plus an optional collection of search
     paths, and returns the full path of the requested executable.  if paths is
     specified, it is the entire list of search paths, and the PATH env is not
     used at all.  otherwise, PATH env is used to look for the program"""
 
-    def is_exe(file_path):
-        return (
-            os.path.exists(file_path)
-            and os.access(file_path, os.X_OK)
-            and os.path.isfile(os.path.realpath(file_path))
-        )
+    # program can be any path-like object, like a pathlib.Path
+    program = os.fspath(program)
+
+    if isinstance(paths, (tuple, list)):
+        search_key = tuple(paths)
+    else:
+        search_key = os.environ.get("PATH", "")
 
+    cache_key = _which_cache_key(program, search_key)
+    if cache_key is None:
+        # our cwd has been removed out from under us, so there's nothing
+        # sensible to key on.  just search
+        return _search_for_program(program, search_key)
+
+    found_path = _which_cache.get(cache_key)
+    if found_path and _is_exe(found_path):
+        return found_path
+
+    found_path = _search_for_program(program, search_key)
+    if found_path:
+        _which_cache[cache_key] = found_path
+    else:
+        _which_cache.pop(cache_key, None)
+    return found_path
+
+
+def _search_for_program(program, search_key):
+    """the uncached half of _which.  search_key is either the PATH string or a
+    tuple of the paths to search"""
     found_path = None
     fpath, fname = os.path.split(program)
 
@@ -486,23 +684,15 @@ def _which(program, paths=None):
     # and we should just test if that program is executable.  if it is, return
     if fpath:
         program = canonicalize(program)
-        if is_exe(program):
+        if _is_exe(program):
             found_path = program
 
     # otherwise, we've just passed in the program name, and we need to search
     # the paths to find where it actually lives
     else:
-        paths_to_search = []
-
-        if isinstance(paths, (tuple, list)):
-            paths_to_search.extend(paths)
-        else:
-            env_paths = os.environ.get("PATH", "").split(os.pathsep)
-            paths_to_search.extend(env_paths)
-
-        for path in paths_to_search:
-            exe_file = os.path.join(canonicalize(path), program)
-            if is_exe(exe_file):
+        for path in _search_dirs(search_key):
+            exe_file = path + program
+            if _is_exe(exe_file):
                 found_path = exe_file
                 break
 
@@ -515,7 +705,9 @@ def resolve_command_path(program):
         # our actual command might have a dash in it, but we can't call
         # that from python (we have to use underscores), so we'll check
         # if a dash version of our underscore command exists and use that
-        # if it does
+        # if it does.  once found, _which remembers the dashed version, so
+        # only the underscored name (which may get installed later) is
+        # searched for again
         if "_" in program:
             path = _which(program.replace("_", "-"))
         if not path:
@@ -533,6 +725,12 @@ def resolve_command(name, command_cls, baked_args=None):
     return cmd
 
 
+# the python loggers backing our Logger instances.  there are only a handful of
+# distinct names, but several Logger instances get created for every command,
+# and logging.getLogger takes the logging module's global lock every time
+_loggers: Dict[str, logging.Logger] = {}
+
+
 class Logger:
     """provides a memory-inexpensive logger.  a gotcha about python's builtin
     logger is that logger objects are never garbage collected.  if you create a
@@ -553,7 +751,10 @@ class Logger:
 
     def __init__(self, name, context=None):
         self.name = name
-        self.log = logging.getLogger(f"{SH_LOGGER_NAME}.{name}")
+        try:
+            self.log = _loggers[name]
+        except KeyError:
+            self.log = _loggers[name] = logging.getLogger(f"{SH_LOGGER_NAME}.{name}")
         self.context = self.sanitize_context(context)
 
     def _format_msg(self, msg, *a):
@@ -572,17 +773,26 @@ class Logger:
         new_context = self.context + "." + context
         return Logger(new_name, new_context)
 
+    # we format our messages ourselves, before they reach the logging module,
+    # so we have to check the level first.  otherwise every debug message gets
+    # formatted (on the hot paths too, like for every chunk of output) even
+    # when nobody is listening
+
     def info(self, msg, *a):
-        self.log.info(self._format_msg(msg, *a))
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info(self._format_msg(msg, *a))
 
     def debug(self, msg, *a):
-        self.log.debug(self._format_msg(msg, *a))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(self._format_msg(msg, *a))
 
     def error(self, msg, *a):
-        self.log.error(self._format_msg(msg, *a))
+        if self.log.isEnabledFor(logging.ERROR):
+            self.log.error(self._format_msg(msg, *a))
 
     def exception(self, msg, *a):
-        self.log.exception(self._format_msg(msg, *a))
+        if self.log.isEnabledFor(logging.ERROR):
+            self.log.exception(self._format_msg(msg, *a))
 
 
 def default_logger_str(cmd, call_args, pid=None):
@@ -632,6 +842,9 @@ class RunningCommand:
         self.call_args = call_args
         self.cmd = cmd
 
+        # our decoded stdout, cached by __str__ once no more output can arrive
+        self._stdout_str = None
+
         self.process = None
         self._waited_until_completion = False
         should_wait = True
@@ -645,11 +858,11 @@ class RunningCommand:
 
         # this event is used when we want to `await` a RunningCommand. see how it gets
         # used in self.__await__
-        try:
-            asyncio.get_running_loop()
-        except RuntimeError:
+        if get_running_loop() is None:
             self.aio_output_complete = None
         else:
+            import asyncio
+
             self.aio_output_complete = asyncio.Event()
 
         # this is used to track if we've already raised StopIteration, and if we
@@ -747,29 +960,46 @@ class RunningCommand:
         if not self._waited_until_completion:
             # if we've been given a timeout, we need to poll is_alive()
             if timeout is not None:
-                waited_for = 0
                 sleep_amt = 0.1
                 alive = False
                 exit_code = None
                 if timeout < 0:
                     raise RuntimeError("timeout cannot be negative")
 
-                # while we still have time to wait, run this loop
+                # we measure against a deadline on the monotonic clock, rather than
+                # adding up how long we meant to sleep for, which drifts
+                deadline = time.monotonic() + timeout
+
+                # if we can get a pidfd for the process, the kernel will wake us up
+                # the moment that it exits, instead of us sleeping and polling
+                pidfd = self.process.open_pidfd()
+                exited = False
+
                 # notice that alive and exit_code are only defined in this loop, but
-                # the loop is also guaranteed to run, defining them, given the
-                # constraints that timeout is non-negative
-                while waited_for <= timeout:
-                    alive, exit_code = self.process.is_alive()
-
-                    # if we're alive, we need to wait some more, but let's sleep
-                    # before we poll again
-                    if alive:
-                        time.sleep(sleep_amt)
-                        waited_for += sleep_amt
-
-                    # but if we're not alive, we're done waiting
-                    else:
-                        break
+                # the loop is guaranteed to run at least once, defining them
+                try:
+                    while True:
+                        alive, exit_code = self.process.is_alive()
+                        remaining = deadline - time.monotonic()
+
+                        # we're done waiting if we're not alive, or out of time
+                        if not alive or remaining <= 0:
+                            break
+
+                        # if the process has exited but is_alive() still says it's
+                        # alive, someone else is reaping it, so we sleep and poll
+                        if pidfd is None or exited:
+                            time.sleep(min(sleep_amt, remaining))
+
+                        # if it didn't exit in the time we had left, we're done
+                        elif not wait_for_pidfd(pidfd, remaining):
+                            break
+
+                        else:
+                            exited = True
+                finally:
+                    if pidfd is not None:
+                        os.close(pidfd)
 
                 # if we've made it this far, and we're still alive, then it means we
                 # timed out waiting
@@ -856,7 +1086,9 @@ class RunningCommand:
         if self._stopped_iteration:
             raise StopIteration()
 
-        pq = self.process._pipe_queue
+        ca = self.call_args
+        pq_get = self.process._pipe_queue.get
+        poll_time = ca["iter_poll_time"]
 
         # the idea with this is, if we're using regular `_iter` (non-asyncio), then we
         # want to have blocking be True when we read from the pipe queue, so our cpu
@@ -865,14 +1097,15 @@ class RunningCommand:
         # in the coroutine that is doing the iteration, this way coroutines have better
         # yielding (see queue_connector in __aiter__).
         block_pq_read = not self._force_noblock_iter
+        noblock = ca["iter_noblock"] or self._force_noblock_iter
 
         # we do this because if get blocks, we can't catch a KeyboardInterrupt
         # so the slight timeout allows for that.
         while True:
             try:
-                chunk = pq.get(block_pq_read, self.call_args["iter_poll_time"])
+                chunk = pq_get(block_pq_read, poll_time)
             except Empty:
-                if self.call_args["iter_noblock"] or self._force_noblock_iter:
+                if noblock:
                     return errno.EWOULDBLOCK
             else:
                 if chunk is None:
@@ -880,9 +1113,7 @@ class RunningCommand:
                     self._stopped_iteration = True
                     raise StopIteration()
                 try:
-                    return chunk.decode(
-                        self.call_args["encoding"], self.call_args["decode_errors"]
-                    )
+                    return chunk.decode(ca["encoding"], ca["decode_errors"])
                 except UnicodeDecodeError:
                     return chunk
 
@@ -900,12 +1131,14 @@ class RunningCommand:
         return wait_for_completion().__await__()
 
     def __aiter__(self):
+        import asyncio
+
         # maxsize is critical to making sure our queue_connector function below yields
         # when it awaits _aio_queue.put(chunk). if we didn't have a maxsize, our loop
         # would happily iterate through `chunk in self` and put onto the queue without
         # any blocking, and therefore no yielding, which would prevent other coroutines
         # from running.
-        self._aio_queue = AQueue(maxsize=1)
+        self._aio_queue = asyncio.Queue(maxsize=1)
         self._force_noblock_iter = True
 
         # the sole purpose of this coroutine is to connect our pipe_queue (which is
@@ -943,10 +1176,20 @@ class RunningCommand:
             get_prepend_stack().pop()
 
     def __str__(self):
+        if self._stdout_str is not None:
+            return self._stdout_str
+
         if self.process and self.stdout:
-            return self.stdout.decode(
+            stdout_str = self.stdout.decode(
                 self.call_args["encoding"], self.call_args["decode_errors"]
             )
+            # once our output thread is done, our stdout can't change anymore,
+            # so we only need to decode it once.  this matters when the same
+            # result gets used several times, like as an argument to other
+            # commands, or with `in` and len()
+            if not self.process._output_thread.is_alive():
+                self._stdout_str = stdout_str
+            return stdout_str
         return ""
 
     def __eq__(self, other):
@@ -978,14 +1221,26 @@ class RunningCommand:
                     return repr(self.stdout)
             return repr("")
 
+    def _to_number(self, convert):
+        # int() and float() both accept ascii bytes, surrounding whitespace
+        # included, so we try the raw stdout first and skip decoding the whole
+        # output.  anything that doesn't parse that way (non-ascii digits, wide
+        # encodings) falls back to the decoded string
+        if self.process:
+            try:
+                return convert(self.stdout)
+            except ValueError:
+                pass
+        return convert(str(self).strip())
+
     def __long__(self):
-        return int(str(self).strip())
+        return self._to_number(int)
 
     def __float__(self):
-        return float(str(self).strip())
+        return self._to_number(float)
 
     def __int__(self):
-        return int(str(self).strip())
+        return self._to_number(int)
 
 
 def output_redirect_is_filename(out):
@@ -994,9 +1249,11 @@ def output_redirect_is_filename(out):
 
 def get_prepend_stack():
     tl = Command.thread_local
-    if not hasattr(tl, "_prepend_stack"):
+    try:
+        return tl._prepend_stack
+    except AttributeError:
         tl._prepend_stack = []
-    return tl._prepend_stack
+        return tl._prepend_stack
 
 
 def special_kwarg_validator(passed_kwargs, merged_kwargs, invalid_list):
@@ -1302,6 +1559,10 @@ class Command:
         self._partial_baked_args = []
         self._partial_call_args = {}
 
+        # the subcommands that have been looked up on us, like git.log, so that
+        # using one repeatedly doesn't bake a new Command every time
+        self._subcommands = {}
+
         # bugfix for functools.wraps.  issue #121
         self.__name__ = str(self)
 
@@ -1316,27 +1577,25 @@ class Command:
         self._path = found
         self.__name__ = str(self)
 
-    def __getattribute__(self, name):
-        # convenience
-        get_attr = partial(object.__getattribute__, self)
-        val = None
-
+    def __getattr__(self, name):
+        # we're only called for attributes that don't exist, so our own
+        # attributes (which the hot paths use constantly) are looked up normally,
+        # and everything else becomes a subcommand.  underscore names are never
+        # subcommands, they're just missing
         if name.startswith("_"):
-            val = get_attr(name)
-
-        elif name == "bake":
-            val = get_attr("bake")
+            raise AttributeError(name)
 
         # here we have a way of getting past shadowed subcommands.  for example,
         # if "git bake" was a thing, we wouldn't be able to do `git.bake()`
         # because `.bake()` is already a method.  so we allow `git.bake_()`
-        elif name.endswith("_"):
+        if name.endswith("_"):
             name = name[:-1]
 
-        if val is None:
-            val = get_attr("bake")(name)
-
-        return val
+        try:
+            return self._subcommands[name]
+        except KeyError:
+            cmd = self._subcommands[name] = self.bake(name)
+            return cmd
 
     @classmethod
     def _extract_call_args(cls, kwargs):
@@ -1344,14 +1603,20 @@ class Command:
         out the special keyword arguments, we return a tuple of special keyword
         args, and kwargs that will go to the exec'ed command"""
 
-        kwargs = kwargs.copy()
+        # we go through the handful of kwargs that were actually passed, rather
+        # than checking for every one of the special kwargs that we support
         call_args = {}
-        for parg, default in cls._call_args.items():
-            key = "_" + parg
+        cmd_kwargs = {}
+        for key, value in kwargs.items():
+            if key.startswith("_") and key[1:] in cls._call_args:
+                call_args[key[1:]] = value
+            else:
+                cmd_kwargs[key] = value
 
-            if key in kwargs:
-                call_args[parg] = kwargs[key]
-                del kwargs[key]
+        # there's nothing to validate if no special kwargs were passed.  our
+        # class's own defaults were validated when they were baked into it
+        if not call_args:
+            return call_args, cmd_kwargs
 
         merged_args = cls._call_args.copy()
         merged_args.update(call_args)
@@ -1366,7 +1631,7 @@ class Command:
             exc_msg = "\n".join(exc_msg)
             raise TypeError(f"Invalid special arguments:\n\n{exc_msg}\n")
 
-        return call_args, kwargs
+        return call_args, cmd_kwargs
 
     def bake(self, *args, **kwargs):
         """returns a new Command object after baking(freezing) the given
@@ -1380,11 +1645,16 @@ class Command:
         fn = type(self)(self._path)
         fn._partial = True
 
+        fn._partial_call_args.update(self._partial_call_args)
+        fn._partial_baked_args.extend(self._partial_baked_args)
+
+        # a bake of nothing is just a copy of us
+        if not args and not kwargs:
+            return fn
+
         call_args, kwargs = self._extract_call_args(kwargs)
 
-        fn._partial_call_args.update(self._partial_call_args)
         fn._partial_call_args.update(call_args)
-        fn._partial_baked_args.extend(self._partial_baked_args)
         sep = call_args.get("long_sep", self._call_args["long_sep"])
         prefix = call_args.get("long_prefix", self._call_args["long_prefix"])
         fn._partial_baked_args.extend(compile_args(args, kwargs, sep, prefix))
@@ -1409,9 +1679,6 @@ class Command:
         get_prepend_stack().pop()
 
     def __call__(self, *args, **kwargs):
-        kwargs = kwargs.copy()
-        args = list(args)
-
         # this will hold our final command, including arguments, that will be
         # exec'ed
         cmd = []
@@ -1420,17 +1687,19 @@ class Command:
         # and their values
         call_args = self.__class__._call_args.copy()
 
-        # aggregate any 'with' contexts
-        for prepend in get_prepend_stack():
-            pcall_args = prepend.call_args.copy()
-            # don't pass the 'with' call arg
-            pcall_args.pop("with", None)
+        # aggregate any 'with' contexts.  usually there aren't any
+        prepend_stack = get_prepend_stack()
+        if prepend_stack:
+            for prepend in prepend_stack:
+                call_args.update(prepend.call_args)
+                # we do not prepend commands used as a 'with' context as they
+                # will be prepended to any nested commands
+                if not kwargs.get("_with", False):
+                    cmd.extend(prepend.cmd)
 
-            call_args.update(pcall_args)
-            # we do not prepend commands used as a 'with' context as they will
-            # be prepended to any nested commands
-            if not kwargs.get("_with", False):
-                cmd.extend(prepend.cmd)
+            # don't pass the 'with' call arg.  we put back our default instead of
+            # copying every context's call args just to drop that one key
+            call_args["with"] = self.__class__._call_args["with"]
 
         cmd.append(self._path)
 
@@ -1438,7 +1707,7 @@ class Command:
         # this early, so that args, kwargs are accurate
         preprocessor = self._partial_call_args.get("arg_preprocess", None)
         if preprocessor:
-            args, kwargs = preprocessor(args, kwargs)
+            args, kwargs = preprocessor(list(args), kwargs)
 
         # here we extract the special kwargs and override any
         # special kwargs from the possibly baked command
@@ -1472,12 +1741,9 @@ class Command:
             args, kwargs, call_args["long_sep"], call_args["long_prefix"]
         )
 
-        # makes sure our arguments are broken up correctly
-        split_args = self._partial_baked_args + processed_args
-
-        final_args = split_args
-
-        cmd.extend(final_args)
+        # our baked args come first, then the ones we were called with
+        cmd.extend(self._partial_baked_args)
+        cmd.extend(processed_args)
 
         # if we're running in foreground mode, we need to completely bypass
         # launching a RunningCommand and OProc and just do a spawn
@@ -1535,15 +1801,18 @@ def compile_args(a, kwargs, sep, prefix):
 
     """
     processed_args = []
+    append = processed_args.append
 
     # aggregate positional args
     for arg in a:
-        if isinstance(arg, (list, tuple)):
+        # most args are plain strings, so we check for those first
+        if type(arg) is str:
+            append(arg)
+        elif isinstance(arg, (list, tuple)):
             if isinstance(arg, GlobResults) and not arg:
                 arg = [arg.path]
 
-            for sub_arg in arg:
-                processed_args.append(sub_arg)
+            processed_args.extend(arg)
         elif isinstance(arg, dict):
             processed_args += _aggregate_keywords(arg, sep, prefix, raw=True)
 
@@ -1551,7 +1820,7 @@ def compile_args(a, kwargs, sep, prefix):
         elif arg is None or arg is False:
             pass
         else:
-            processed_args.append(str(arg))
+            append(str(arg))
 
     # aggregate the keyword arguments
     processed_args += _aggregate_keywords(kwargs, sep, prefix)
@@ -1595,6 +1864,8 @@ def _aggregate_keywords(keywords, sep, prefix, raw=False):
     """
 
     processed = []
+    append = processed.append
+    split_values = sep is None or sep == " "
 
     for k, maybe_list_of_v in keywords.items():
         # turn our value(s) into a list of values so that we can process them
@@ -1603,35 +1874,37 @@ def _aggregate_keywords(keywords, sep, prefix, raw=False):
         if isinstance(maybe_list_of_v, (list, tuple)):
             list_of_v = maybe_list_of_v
 
-        for v in list_of_v:
-            # we're passing a short arg as a kwarg, example:
-            # cut(d="\t")
-            if len(k) == 1:
+        # we're passing a short arg as a kwarg, example:
+        # cut(d="\t")
+        if len(k) == 1:
+            for v in list_of_v:
                 if v is not False:
-                    processed.append("-" + k)
+                    append("-" + k)
                     if v is not True:
-                        processed.append(str(v))
+                        append(str(v))
+            continue
 
-            # we're doing a long arg
-            else:
-                if not raw:
-                    k = k.replace("_", "-")
-
-                # if it's true, it has no value, just pass the name
-                if v is True:
-                    processed.append(prefix + k)
-                # if it's false, skip passing it
-                elif v is False:
-                    pass
+        # we're doing a long arg.  the name is the same for every value, so we
+        # only build it once
+        if not raw:
+            k = k.replace("_", "-")
+        name = prefix + k
 
-                # we may need to break the argument up into multiple arguments
-                elif sep is None or sep == " ":
-                    processed.append(prefix + k)
-                    processed.append(str(v))
-                # otherwise just join it together into a single argument
-                else:
-                    arg = f"{prefix}{k}{sep}{v}"
-                    processed.append(arg)
+        for v in list_of_v:
+            # if it's true, it has no value, just pass the name
+            if v is True:
+                append(name)
+            # if it's false, skip passing it
+            elif v is False:
+                pass
+
+            # we may need to break the argument up into multiple arguments
+            elif split_values:
+                append(name)
+                append(str(v))
+            # otherwise just join it together into a single argument
+            else:
+                append(f"{name}{sep}{v}")
 
     return processed
 
@@ -1758,6 +2031,14 @@ def handle_process_exit_code(exit_code):
     return exit_code
 
 
+def wait_for_pidfd(pidfd, timeout):
+    """blocks until the process behind a pidfd has exited, or until timeout
+    seconds have passed.  returns whether the process exited"""
+    poller = select.poll()
+    poller.register(pidfd, select.POLLIN)
+    return bool(no_interrupt(poller.poll, timeout * 1000))
+
+
 def no_interrupt(syscall, *args, **kwargs):
     """a helper for making system calls immune to EINTR"""
     ret = None
@@ -1831,6 +2112,16 @@ class OProc:
         if ca["piped"]:
             ca["tty_out"] = False
 
+        # python=3.6, locale=c will fail test_unicode_arg if we don't explicitly
+        # encode to bytes via our desired encoding. this does not seem to be the
+        # case in other python versions, even if locale=c.  we do it here, before
+        # the fork, so the child has less to do before exec.  a bad arg still
+        # raises the ForkException it used to, when this happened in the child
+        try:
+            bytes_cmd = [c.encode(ca["encoding"]) for c in cmd]
+        except UnicodeEncodeError:
+            raise ForkException(traceback.format_exc())
+
         self._stdin_process = None
 
         # if the objects that we are passing to the OProc happen to be a
@@ -2096,17 +2387,23 @@ class OProc:
                         # Python2, FileNotFoundError on Python3. The latter doesn't
                         # exist on Python2, but inherits from IOError, which does.
                         inherited_fds = os.listdir("/proc/self/fd")
-                    inherited_fds = {int(fd) for fd in inherited_fds} - pass_fds
-                    for fd in inherited_fds:
-                        try:
-                            os.close(fd)
-                        except OSError:
-                            pass
-
-                # python=3.6, locale=c will fail test_unicode_arg if we don't
-                # explicitly encode to bytes via our desired encoding. this does
-                # not seem to be the case in other python versions, even if locale=c
-                bytes_cmd = [c.encode(ca["encoding"]) for c in cmd]
+
+                    # rather than closing each fd on its own, we close the spans
+                    # between the fds that we're keeping.  os.closerange does each
+                    # span with a single close_range() call, where the system has
+                    # it, and ignores fds in the span that aren't open.  we never
+                    # give it an empty span, because os.closerange(0, 0) closes
+                    # every fd on pythons that use close_range()
+                    max_fd = max(int(fd) for fd in inherited_fds)
+                    low = 0
+                    for keep in sorted(pass_fds):
+                        if keep > max_fd:
+                            break
+                        if low < keep:
+                            os.closerange(low, keep)
+                        low = keep + 1
+                    if low <= max_fd:
+                        os.closerange(low, max_fd + 1)
 
                 # actually execute the process
                 if ca["env"] is None:
@@ -2203,6 +2500,12 @@ class OProc:
             self._stdout = deque(maxlen=ca["internal_bufsize"])
             self._stderr = deque(maxlen=ca["internal_bufsize"])
 
+            # the joined contents of those deques, once our output thread is done
+            # adding to them, after which the deques are emptied.  see the stdout
+            # and stderr properties
+            self._stdout_bytes = None
+            self._stderr_bytes = None
+
             if ca["tty_in"] and not stdin_is_fd_based:
                 setwinsize(self._stdin_parent_fd, ca["tty_size"])
 
@@ -2349,6 +2652,7 @@ class OProc:
                 handle_exit_code,
                 self.is_alive,
                 self._quit_threads,
+                self.open_pidfd,
             )
 
             # start the main io threads. stdin thread is not needed if we are
@@ -2366,6 +2670,7 @@ class OProc:
                     self._stdin_stream,
                     self.is_alive,
                     self._quit_threads,
+                    self.open_pidfd,
                     close_before_term,
                 )
 
@@ -2381,9 +2686,8 @@ class OProc:
             # be notified that our output is finished.
             # if the `sh` command was launched from within a thread (so we're not in
             # the main thread), then we won't have an event loop.
-            try:
-                loop = asyncio.get_running_loop()
-            except RuntimeError:
+            loop = get_running_loop()
+            if loop is None:
 
                 def output_complete():
                     pass
@@ -2405,6 +2709,7 @@ class OProc:
                 self._timeout_event,
                 self.is_alive,
                 self._quit_threads,
+                self.open_pidfd,
                 self._stop_output_event,
                 output_complete,
             )
@@ -2423,11 +2728,27 @@ class OProc:
 
     @property
     def stdout(self):
-        return "".encode(self.call_args["encoding"]).join(self._stdout)
+        if self._stdout_bytes is None:
+            stdout = b"".join(self._stdout)
+            # once our output thread is done, nothing more gets added, so we only
+            # need to join the chunks once, no matter how often we're asked.  and
+            # we let go of the chunks, so a finished command that's kept around
+            # doesn't hold its output twice
+            if self._output_thread.is_alive():
+                return stdout
+            self._stdout_bytes = stdout
+            self._stdout.clear()
+        return self._stdout_bytes
 
     @property
     def stderr(self):
-        return "".encode(self.call_args["encoding"]).join(self._stderr)
+        if self._stderr_bytes is None:
+            stderr = b"".join(self._stderr)
+            if self._output_thread.is_alive():
+                return stderr
+            self._stderr_bytes = stderr
+            self._stderr.clear()
+        return self._stderr_bytes
 
     def get_pgid(self):
         """return the CURRENT group id of the process. this differs from
@@ -2512,6 +2833,27 @@ class OProc:
             if witnessed_end:
                 self._process_just_ended()
 
+    def open_pidfd(self):
+        """returns a new pidfd for our child process, or None if we can't get
+        one.  the caller is responsible for closing it"""
+        if not HAS_PIDFD or self.exit_code is not None:
+            return None
+
+        # our pid can only be reaped (after which it could be reused by some
+        # other process) while the wait lock is held.  so we hold it while we
+        # open the pidfd, to be sure that it refers to our child.  if someone is
+        # already blocked in .wait(), we don't wait for them
+        if not self._wait_lock.acquire(blocking=False):
+            return None
+        try:
+            if self.exit_code is not None:
+                return None
+            return os.pidfd_open(self.pid)
+        except OSError:
+            return None
+        finally:
+            self._wait_lock.release()
+
     def _process_just_ended(self):
         if self._timeout_timer:
             self._timeout_timer.cancel()
@@ -2576,7 +2918,34 @@ class OProc:
             self._process_just_ended()
 
 
-def input_thread(log, stdin, is_alive, quit_thread, close_before_term):
+def wait_for_process_exit(is_alive, quit_thread, open_pidfd):
+    """blocks one of our threads until is_alive() reports that the process has
+    ended, and returns its exit code"""
+    alive, exit_code = is_alive()
+    if not alive:
+        return exit_code
+
+    # with a pidfd, the kernel wakes us up as soon as the process exits, instead
+    # of us finding out on our next poll.  if it has exited but is_alive() still
+    # says otherwise, then someone is in .wait() reaping it, and that sets
+    # quit_thread once they're done
+    pidfd = open_pidfd()
+    exited = False
+    try:
+        while alive:
+            if pidfd is not None and not exited:
+                exited = wait_for_pidfd(pidfd, 1)
+            else:
+                quit_thread.wait(1)
+            alive, exit_code = is_alive()
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+    return exit_code
+
+
+def input_thread(log, stdin, is_alive, quit_thread, open_pidfd, close_before_term):
     """this is run in a separate thread.  it writes into our process's
     stdin (a streamwriter) and waits the process to end AND everything that
     can be written to be written"""
@@ -2586,24 +2955,26 @@ def input_thread(log, stdin, is_alive, quit_thread, close_before_term):
     poller = Poller()
     poller.register_write(stdin)
 
-    while poller and alive:
-        changed = poller.poll(1)
-        for fd, events in changed:
-            if events & (POLLER_EVENT_WRITE | POLLER_EVENT_HUP):
-                log.debug("%r ready for more input", stdin)
-                done = stdin.write()
+    try:
+        while poller and alive:
+            changed = poller.poll(1)
+            for fd, events in changed:
+                if events & (POLLER_EVENT_WRITE | POLLER_EVENT_HUP):
+                    log.debug("%r ready for more input", stdin)
+                    done = stdin.write()
 
-                if done:
-                    poller.unregister(stdin)
-                    if close_before_term:
-                        stdin.close()
-                        closed = True
+                    if done:
+                        poller.unregister(stdin)
+                        if close_before_term:
+                            stdin.close()
+                            closed = True
 
-        alive, _ = is_alive()
+            alive, _ = is_alive()
+    finally:
+        poller.close()
 
-    while alive:
-        quit_thread.wait(1)
-        alive, _ = is_alive()
+    if alive:
+        wait_for_process_exit(is_alive, quit_thread, open_pidfd)
 
     if not closed:
         stdin.close()
@@ -2615,7 +2986,7 @@ def event_wait(ev, timeout=None):
 
 
 def background_thread(
-    timeout_fn, timeout_event, handle_exit_code, is_alive, quit_thread
+    timeout_fn, timeout_event, handle_exit_code, is_alive, quit_thread, open_pidfd
 ):
     """handles the timeout logic"""
 
@@ -2635,12 +3006,7 @@ def background_thread(
     # user's awareness, and cannot be caught or used in any way, so it's ok to
     # suppress this during the tests
     if handle_exit_code and not RUNNING_TESTS:  # pragma: no cover
-        alive = True
-        exit_code = None
-        while alive:
-            quit_thread.wait(1)
-            alive, exit_code = is_alive()
-
+        exit_code = wait_for_process_exit(is_alive, quit_thread, open_pidfd)
         handle_exit_code(exit_code)
 
 
@@ -2651,6 +3017,7 @@ def output_thread(
     timeout_event,
     is_alive,
     quit_thread,
+    open_pidfd,
     stop_output_event,
     output_complete,
 ):
@@ -2669,32 +3036,32 @@ def output_thread(
     # is done altogether being read from, we remove it from our list of
     # things to poll.  when no more things are left to poll, we leave this
     # loop and clean up
-    while poller:
-        changed = no_interrupt(poller.poll, 0.1)
-        for f, events in changed:
-            if events & (POLLER_EVENT_READ | POLLER_EVENT_HUP):
-                log.debug("%r ready to be read from", f)
-                done = f.read()
-                if done:
-                    poller.unregister(f)
-            elif events & POLLER_EVENT_ERROR:
-                # for some reason, we have to just ignore streams that have had an
-                # error.  i'm not exactly sure why, but don't remove this until we
-                # figure that out, and create a test for it
-                pass
+    try:
+        while poller:
+            changed = no_interrupt(poller.poll, 0.1)
+            for f, events in changed:
+                if events & (POLLER_EVENT_READ | POLLER_EVENT_HUP):
+                    log.debug("%r ready to be read from", f)
+                    done = f.read()
+                    if done:
+                        poller.unregister(f)
+                elif events & POLLER_EVENT_ERROR:
+                    # for some reason, we have to just ignore streams that have had
+                    # an error.  i'm not exactly sure why, but don't remove this
+                    # until we figure that out, and create a test for it
+                    pass
 
-        if timeout_event and timeout_event.is_set():
-            break
+            if timeout_event and timeout_event.is_set():
+                break
 
-        if stop_output_event.is_set():
-            break
+            if stop_output_event.is_set():
+                break
+    finally:
+        poller.close()
 
     # we need to wait until the process is guaranteed dead before closing our
     # outputs, otherwise SIGPIPE
-    alive, _ = is_alive()
-    while alive:
-        quit_thread.wait(1)
-        alive, _ = is_alive()
+    wait_for_process_exit(is_alive, quit_thread, open_pidfd)
 
     if stdout:
         stdout.close()
@@ -2798,12 +3165,22 @@ def get_callable_chunk_reader(stdin):
     return fn
 
 
+# how much a default linux pipe can hold.  reading or writing less than this at
+# a time just means more trips around our io threads' loops
+PIPE_CAPACITY = 64 * 1024
+
+# how much of a string or file we hand to the StreamWriter at a time.  each chunk
+# costs us a trip around the input thread's loop and a write() to the process,
+# so we read as much as a default pipe can hold
+STDIN_CHUNK_SIZE = PIPE_CAPACITY
+
+
 def get_iter_string_reader(stdin):
     """return an iterator that returns a chunk of a string every time it is
     called.  notice that even though bufsize_type might be line buffered, we're
     not doing any line buffering here.  that's because our StreamBufferer
     handles all buffering.  we just need to return a reasonable-sized chunk."""
-    bufsize = 1024
+    bufsize = STDIN_CHUNK_SIZE
     iter_str = (stdin[i : i + bufsize] for i in range(0, len(stdin), bufsize))
     return get_iter_chunk_reader(iter_str)
 
@@ -2820,7 +3197,7 @@ def get_iter_chunk_reader(stdin):
 
 
 def get_file_chunk_reader(stdin):
-    bufsize = 1024
+    bufsize = STDIN_CHUNK_SIZE
 
     def fn():
         # python 3.* includes a fileno on stringios, but accessing it throws an
@@ -2836,8 +3213,11 @@ def get_file_chunk_reader(stdin):
         # for fileno because StringIO/BytesIO cannot be used in a poll
         if is_real_file and hasattr(stdin, "fileno"):
             poller = Poller()
-            poller.register_read(stdin)
-            changed = poller.poll(0.1)
+            try:
+                poller.register_read(stdin)
+                changed = poller.poll(0.1)
+            finally:
+                poller.close()
             ready = False
             for fd, events in changed:
                 if events & (POLLER_EVENT_READ | POLLER_EVENT_HUP):
@@ -2857,12 +3237,14 @@ def get_file_chunk_reader(stdin):
 def bufsize_type_to_bufsize(bf_type):
     """for a given bufsize type, return the actual bufsize we will read.
     notice that although 1 means "newline-buffered", we're reading a chunk size
-    of 1024.  this is because we have to read something.  we let a
-    StreamBufferer instance handle splitting our chunk on newlines"""
+    of 64k.  this is because we have to read something, and reading as much as
+    a default pipe can hold keeps the number of read() calls down on processes
+    with a lot of output.  we let a StreamBufferer instance handle splitting our
+    chunk on newlines"""
 
     # newlines
     if bf_type == 1:
-        bufsize = 1024
+        bufsize = PIPE_CAPACITY
     # unbuffered
     elif bf_type == 0:
         bufsize = 1
@@ -2946,12 +3328,15 @@ class StreamWriter:
         if not isinstance(chunk, bytes):
             chunk = chunk.encode(self.encoding)
 
-        for proc_chunk in self.stream_bufferer.process(chunk):
-            self.log.debug("got chunk size %d: %r", len(proc_chunk), proc_chunk[:30])
-
-            self.log.debug("writing chunk to process")
+        # the bufferer can give us many chunks at once, for example every line of
+        # our chunk when we're line buffered, so we gather them into as few
+        # writes as we can
+        proc_chunks = self.stream_bufferer.process(chunk)
+        for i in range(0, len(proc_chunks), IOV_MAX):
+            batch = proc_chunks[i : i + IOV_MAX]
+            self.log.debug("writing %d chunks to process", len(batch))
             try:
-                os.write(self.stream, proc_chunk)
+                os.writev(self.stream, batch)
             except OSError:
                 self.log.debug("OSError writing stdin chunk")
                 return True
@@ -3232,21 +3617,27 @@ class StreamBufferer:
             elif self.type == 1:
                 total_to_write = []
                 nl = "\n".encode(self.encoding)
+
+                # we walk an offset through the chunk instead of re-slicing the
+                # remainder after every line, otherwise a big chunk made of many
+                # short lines gets copied over and over
+                start = 0
                 while True:
-                    newline = chunk.find(nl)
+                    newline = chunk.find(nl, start)
                     if newline == -1:
                         break
 
-                    chunk_to_write = chunk[: newline + 1]
+                    chunk_to_write = chunk[start : newline + 1]
                     if self.buffer:
                         chunk_to_write = b"".join(self.buffer) + chunk_to_write
 
                         self.buffer = []
                         self.n_buffer_count = 0
 
-                    chunk = chunk[newline + 1 :]
+                    start = newline + 1
                     total_to_write.append(chunk_to_write)
 
+                chunk = chunk[start:]
                 if chunk:
                     self.buffer.append(chunk)
                     self.n_buffer_count += len(chunk)
@@ -3258,7 +3649,7 @@ class StreamBufferer:
                 while True:
                     overage = self.n_buffer_count + len(chunk) - self.type
                     if overage >= 0:
-                        ret = "".encode(self.encoding).join(self.buffer) + chunk
+                        ret = b"".join(self.buffer) + chunk
                         chunk_to_write = ret[: self.type]
                         chunk = ret[self.type :]
                         total_to_write.append(chunk_to_write)
@@ -3281,7 +3672,7 @@ class StreamBufferer:
         self._buffering_lock.acquire()
         self.log.debug("got buffering lock for flushing buffer")
         try:
-            ret = "".encode(self.encoding).join(self.buffer)
+            ret = b"".join(self.buffer)
             self.buffer = []
             return ret
         finally:
@@ -3375,6 +3766,7 @@ class Environment(dict):
         "_args",
         "pushd",
         "glob",
+        "clear_which_cache",
         "contrib",
     }
 
@@ -3389,6 +3781,16 @@ class Environment(dict):
         self.globs = globs
         self.baked_args = baked_args or {}
 
+        # every name that misses the allowlist ends up resolving a command, so
+        # look up our (possibly baked) Command class once, instead of on every
+        # lookup
+        self.command_cls = globs[Command.__name__]
+
+        # the Commands we've built for names, so that using the same program over
+        # and over doesn't construct (and bake) a new Command every time.  see
+        # self._resolve_command
+        self._commands: Dict[str, Command] = {}
+
     def __getitem__(self, k):
         if k == "args":
             # Let the deprecated '_args' context manager be imported as 'args'
@@ -3418,7 +3820,7 @@ class Environment(dict):
             raise AttributeError
 
         # is it a command?
-        cmd = resolve_command(k, self.globs[Command.__name__], self.baked_args)
+        cmd = self._resolve_command(k)
         if cmd:
             return cmd
 
@@ -3440,6 +3842,23 @@ class Environment(dict):
         # nothing found, raise an exception
         raise CommandNotFound(k)
 
+    def _resolve_command(self, k):
+        # we still resolve the path every time, because PATH, our cwd, or what's
+        # installed may have changed since the last time (and that lookup is
+        # cached anyway).  but if it's the same program as before, we can hand
+        # back the same Command
+        path = resolve_command_path(k)
+        if not path:
+            return None
+
+        cmd = self._commands.get(k)
+        if cmd is None or cmd._path != path:
+            cmd = self.command_cls(path)
+            if self.baked_args:
+                cmd = cmd.bake(**self.baked_args)
+            self._commands[k] = cmd
+        return cmd
+
     # Methods that begin with "b_" are implementations of shell built-ins that
     # people are used to, but which may not have an executable equivalent.
     @staticmethod
@@ -3489,6 +3908,7 @@ def bash(orig):
 def sudo(orig):  # pragma: no cover
     """a nicer version of sudo that uses getpass to ask for a password, or
     allows the first argument to be a string password"""
+    import getpass
 
     prompt = f"[sudo] password for {getpass.getuser()}: "
 
@@ -3514,6 +3934,7 @@ def sudo(orig):  # pragma: no cover
 @contrib("ssh")
 def ssh(orig):  # pragma: no cover
     """An ssh command for automatic password login"""
+    import getpass
 
     class SessionContent:
         def __init__(self):
@@ -3607,6 +4028,12 @@ def ssh(orig):  # pragma: no cover
 def run_repl(env):  # pragma: no cover
     print(f"\n>> sh v{__version__}\n>> https://github.com/amoffat/sh\n")
 
+    # lines tend to get repeated at a repl, and a code object can be exec'd any
+    # number of times, so we hang on to the recent ones
+    @lru_cache(maxsize=256)
+    def compile_line(line):
+        return compile(line, "<dummy>", "single")
+
     while True:
         try:
             line = input("sh> ")
@@ -3614,7 +4041,7 @@ def run_repl(env):  # pragma: no cover
             break
 
         try:
-            exec(compile(line, "<dummy>", "single"), env, env)
+            exec(compile_line(line), env, env)
         except SystemExit:
             break
         except:  # noqa: E722
@@ -3655,7 +4082,11 @@ class SelfWrapper(ModuleType):
             call_args, _ = command_cls._extract_call_args(baked_args)
             cls_attrs["_call_args"] = cls_attrs["_call_args"].copy()
             cls_attrs["_call_args"].update(call_args)
-        globs = globals().copy()
+        # our Environment only looks up its allowlisted names (and the Command
+        # class) in here, so that's all we give it, rather than a copy of every
+        # global in the module for each sh that gets baked
+        module_globals = globals()
+        globs = {k: module_globals[k] for k in Environment.allowlist}
         globs[command_cls.__name__] = type(
             command_cls.__name__, command_cls.__bases__, cls_attrs
         )
@@ -3663,7 +4094,14 @@ class SelfWrapper(ModuleType):
         self.__env = Environment(globs, baked_args=baked_args)
 
     def __getattr__(self, name):
-        return self.__env[name]
+        val = self.__env[name]
+        # our allowlisted names and the ReturnCode exceptions always resolve to the
+        # same object, so we keep them on the module, and python won't come back
+        # here for them.  commands and environment variables must be looked up
+        # every time, because PATH and os.environ can change underneath us
+        if name in Environment.allowlist or isinstance(val, ErrorReturnCodeMeta):
+            setattr(self, name, val)
+        return val
 
     def bake(self, **kwargs):
         baked_args = self.__env.baked_args.copy()
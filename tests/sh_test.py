@@ -108,6 +108,7 @@ requires_utf8 = unittest.skipUnless(
     sh.DEFAULT_ENCODING == "UTF-8", "System encoding must be UTF-8"
 )
 not_macos = unittest.skipUnless(not IS_MACOS, "Doesn't work on MacOS")
+requires_pidfd = unittest.skipUnless(hasattr(os, "pidfd_open"), "Requires pidfd")
 
 
 def requires_poller(poller):
@@ -150,6 +151,16 @@ def create_tmp_test(code, prefix="tmp", delete=True, **kwargs):
     return py
 
 
+def create_tmp_exe(bin_dir, name, mode=0o755):
+    """creates a do-nothing program called `name` in bin_dir, for the tests
+    that look programs up on a search path, and returns its path"""
+    path = join(bin_dir, name)
+    with open(path, "w") as h:
+        h.write("#!/bin/sh\n")
+    os.chmod(path, mode)
+    return path
+
+
 class BaseTests(unittest.TestCase):
     def setUp(self):
         warnings.simplefilter("ignore", ResourceWarning)
@@ -202,6 +213,17 @@ class FunctionalTests(BaseTests):
         out = str(ls)
         self.assertEqual(out, actual_location)
 
+    def test_decoded_stdout_is_cached(self):
+        out = python("-c", "print('hi')")
+        self.assertEqual(str(out), "hi\n")
+        self.assertIs(str(out), str(out))
+
+        # the cached output gets passed along as an argument, too
+        self.assertEqual(
+            pythons("-c", "import sys; print(sys.argv[1:])", out, out),
+            "['hi\\n', 'hi\\n']\n",
+        )
+
     def test_unicode_arg(self):
         from sh import echo
 
@@ -210,6 +232,15 @@ class FunctionalTests(BaseTests):
         output = p.strip()
         self.assertEqual(test, output)
 
+    def test_unencodable_arg(self):
+        from sh import echo
+
+        # the argv is encoded before we fork, but it fails the same way it did
+        # when the child encoded it
+        with self.assertRaises(sh.ForkException) as cm:
+            echo("\udcff", _encoding="utf8")
+        self.assertIn("UnicodeEncodeError", str(cm.exception))
+
     def test_unicode_exception(self):
         from sh import ErrorReturnCode
 
@@ -256,6 +287,25 @@ print(args[0])
         out = python(py.name, 3).strip()
         self.assertEqual(out, "3")
 
+    def test_numeric_coercion(self):
+        py = create_tmp_test(
+            """
+import sys
+sys.stdout.buffer.write(sys.argv[1].encode(sys.argv[2]))
+"""
+        )
+
+        self.assertEqual(int(python(py.name, " 42\n", "ascii")), 42)
+        self.assertEqual(float(python(py.name, "1.5\n", "ascii")), 1.5)
+
+        # output that can't be parsed as raw bytes, like non-ascii digits, falls
+        # back to the decoded string
+        arabic_digits = "\u0664\u0662\n"
+        out = python(py.name, arabic_digits, "utf-8", _encoding="utf-8")
+        self.assertEqual(int(out), 42)
+
+        self.assertRaises(ValueError, int, python(py.name, "nope", "ascii"))
+
     def test_arg_string_coercion(self):
         py = create_tmp_test(
             """
@@ -503,6 +553,35 @@ while True:
 
         self.assertEqual(out, test_string.upper())
 
+    def test_manual_stdin_large(self):
+        import tempfile
+
+        from sh import tr
+
+        # bigger than a single stdin chunk, and not a multiple of it
+        test_string = "testing\nherp\nderp\n" * 10000
+
+        out = tr("[:lower:]", "[:upper:]", _in=test_string)
+        self.assertEqual(out, test_string.upper())
+
+        stdin = tempfile.NamedTemporaryFile()
+        stdin.write(test_string.encode())
+        stdin.flush()
+        stdin.seek(0)
+
+        out = tr("[:lower:]", "[:upper:]", _in=stdin)
+        self.assertEqual(out, test_string.upper())
+
+    def test_manual_stdin_line_buffered(self):
+        from sh import tr
+
+        # line buffering splits each chunk into many more lines than we can write
+        # in a single go
+        test_string = "".join(f"line {i}\n" for i in range(5000))
+
+        out = tr("[:lower:]", "[:upper:]", _in=test_string, _in_bufsize=1)
+        self.assertEqual(out, test_string.upper())
+
     def test_manual_stdin_queue(self):
         from sh import tr
 
@@ -590,6 +669,114 @@ print("hi")
         found_path = which(test_name, [test_path])
         self.assertEqual(found_path, py.name)
 
+    def test_which_pathlike(self):
+        which = sh._SelfWrapper__env.b_which
+        ls = which("ls")
+        self.assertEqual(which(Path("ls")), ls)
+        self.assertEqual(sh.Command(Path("ls"))._path, ls)
+
+        with tempfile.TemporaryDirectory() as bin_dir:
+            exe = create_tmp_exe(bin_dir, "pathlike-exe")
+            self.assertEqual(which(Path("pathlike-exe"), [bin_dir]), exe)
+            self.assertEqual(which(Path(exe)), exe)
+
+    def test_which_symlinks(self):
+        which = sh._SelfWrapper__env.b_which
+        with tempfile.TemporaryDirectory() as bin_dir:
+            exe = create_tmp_exe(bin_dir, "real-exe")
+            link = join(bin_dir, "linked-exe")
+            os.symlink(exe, link)
+            os.symlink(join(bin_dir, "missing"), join(bin_dir, "dangling-exe"))
+
+            self.assertEqual(which("linked-exe", [bin_dir]), link)
+            self.assertEqual(which("dangling-exe", [bin_dir]), None)
+
+    def test_which_cache(self):
+        which = sh._SelfWrapper__env.b_which
+        with tempfile.TemporaryDirectory() as first_dir:
+            with tempfile.TemporaryDirectory() as second_dir:
+                search = [first_dir, second_dir]
+                self.assertEqual(which("cached-exe", search), None)
+
+                # misses aren't remembered
+                second = create_tmp_exe(second_dir, "cached-exe")
+                self.assertEqual(which("cached-exe", search), second)
+
+                # hits are, until we clear them
+                first = create_tmp_exe(first_dir, "cached-exe")
+                self.assertEqual(which("cached-exe", search), second)
+                sh.clear_which_cache()
+                self.assertEqual(which("cached-exe", search), first)
+
+                # a remembered program that has gone away is searched for again
+                os.unlink(first)
+                self.assertEqual(which("cached-exe", search), second)
+                os.unlink(second)
+                self.assertEqual(which("cached-exe", search), None)
+
+    def test_which_cache_ignores_cwd(self):
+        which = sh._SelfWrapper__env.b_which
+        which_cache = sh._SelfWrapper__self_module._which_cache
+        sh.clear_which_cache()
+
+        # with nothing relative in the lookup, where we are doesn't matter, so
+        # moving around doesn't fill the cache
+        ls = which("ls")
+        sh.ls
+        cached = len(which_cache)
+        for _ in range(3):
+            with tempfile.TemporaryDirectory() as tmp_dir, sh.pushd(tmp_dir):
+                self.assertEqual(which("ls"), ls)
+                self.assertEqual(sh.ls._path, ls)
+        self.assertEqual(len(which_cache), cached)
+
+    def test_command_lookup_reuse(self):
+        self.assertIs(sh.ls, sh.ls)
+
+        # but a different program gets a different Command
+        old_path = os.environ["PATH"]
+        with tempfile.TemporaryDirectory() as bin_dir:
+            exe = create_tmp_exe(bin_dir, "ls")
+            os.environ["PATH"] = bin_dir + os.pathsep + old_path
+            try:
+                self.assertEqual(str(sh.ls), exe)
+            finally:
+                os.environ["PATH"] = old_path
+
+        self.assertNotEqual(str(sh.ls), exe)
+
+    def test_dashed_command_lookup(self):
+        old_path = os.environ["PATH"]
+        with tempfile.TemporaryDirectory() as bin_dir:
+            dashed = create_tmp_exe(bin_dir, "sh-test-dashed")
+            os.environ["PATH"] = bin_dir + os.pathsep + old_path
+            try:
+                self.assertEqual(str(sh.sh_test_dashed), dashed)
+                with sh.pushd(bin_dir):
+                    self.assertEqual(str(sh.sh_test_dashed), dashed)
+
+                # an underscored program installed after we've found the dashed
+                # one still wins, without having to clear anything
+                underscored = create_tmp_exe(bin_dir, "sh_test_dashed")
+                self.assertEqual(str(sh.sh_test_dashed), underscored)
+            finally:
+                os.environ["PATH"] = old_path
+
+    def test_which_relative_paths(self):
+        which = sh._SelfWrapper__env.b_which
+        py = create_tmp_test("")
+        test_dir, test_name = os.path.split(py.name)
+
+        # relative search paths are relative to wherever we are at the time
+        with sh.pushd(test_dir):
+            self.assertEqual(which(test_name, ["."]), py.name)
+        other_dir = tempfile.mkdtemp()
+        try:
+            with sh.pushd(other_dir):
+                self.assertEqual(which(test_name, ["."]), None)
+        finally:
+            os.rmdir(other_dir)
+
     def test_no_close_fds(self):
         # guarantee some extra fds in our parent process that don't close on exec. we
         # have to explicitly do this because at some point (I believe python 3.4),
@@ -1815,6 +2002,29 @@ sys.exit(1)
 
         self.assertRaises(sh.ErrorReturnCode_1, asyncio.run, main())
 
+    @requires_pidfd
+    def test_async_exit_after_output_closed(self):
+        # our output is done well before we exit, so the only thing holding up
+        # the await is noticing that we've exited
+        py = create_tmp_test(
+            """
+import os
+import time
+os.close(1)
+os.close(2)
+time.sleep(0.2)
+"""
+        )
+
+        async def main():
+            return await python(py.name, _async=True, _return_cmd=True)
+
+        start = time.time()
+        p = asyncio.run(main())
+        self.assertLess(time.time() - start, 30)
+        self.assertEqual(p.exit_code, 0)
+        self.assertFalse(p.is_alive())
+
     def test_handle_both_out_and_err(self):
         py = create_tmp_test(
             """
@@ -2277,6 +2487,19 @@ sys.stdout.write(sys.argv[1])
         output = cat(_in="a" * 1000, _internal_bufsize=50, _out_bufsize=2)
         self.assertEqual(len(output), 100)
 
+    def test_finished_output_joined_once(self):
+        from sh import cat
+
+        p = cat(_in="a" * 1000, _out_bufsize=10, _return_cmd=True)
+        self.assertEqual(p.stdout, b"a" * 1000)
+        self.assertIs(p.stdout, p.stdout)
+
+        # and the chunks it was joined from aren't kept alongside it
+        self.assertEqual(len(p.process._stdout), 0)
+        self.assertEqual(p.stderr, b"")
+        self.assertEqual(len(p.process._stderr), 0)
+        self.assertEqual(str(p), "a" * 1000)
+
     def test_change_stdout_buffering(self):
         py = create_tmp_test(
             """
@@ -2384,6 +2607,22 @@ sys.stdout.write("line1")
         p = sh.sleep(1, _bg=True)
         p.wait(timeout=5)
 
+    def test_timeout_wait_returns_on_exit(self):
+        # a process that exits before the timeout is waited for, not timed out
+        p = sh.sleep(0.3, _bg=True)
+        p.wait(timeout=30)
+        self.assertEqual(p.exit_code, 0)
+
+        # and one that doesn't times out, instead of being waited out
+        p = sh.sleep(60, _bg=True)
+        try:
+            started = time.time()
+            self.assertRaises(sh.TimeoutException, p.wait, timeout=0.5)
+            self.assertLess(time.time() - started, 30)
+            self.assertTrue(p.is_alive())
+        finally:
+            p.terminate()
+
     def test_timeout_wait_negative(self):
         p = sh.sleep(3, _bg=True)
         self.assertRaises(RuntimeError, p.wait, timeout=-3)
@@ -2996,6 +3235,19 @@ sys.stdout.write(sys.argv[1])
         out = pythons.bake(py.name).bake_()
         self.assertEqual("bake", out)
 
+    def test_missing_private_attr_is_not_subcommand(self):
+        self.assertRaises(AttributeError, getattr, sh.ls, "_nonexistent")
+        self.assertRaises(AttributeError, getattr, sh.ls, "__nonexistent__")
+        self.assertFalse(hasattr(sh.ls, "_nonexistent"))
+        self.assertEqual(str(sh.ls.nonexistent), f"{sh.ls} nonexistent")
+
+    def test_subcommand_reuse(self):
+        cmd = sh.ls.bake(_tty_out=False)
+        self.assertIs(cmd.log, cmd.log)
+        self.assertIs(cmd.bake_, cmd.bake_)
+        self.assertIsNot(cmd.log, cmd.status)
+        self.assertEqual(str(cmd.log), f"{sh.ls} log")
+
     def test_no_proc_no_attr(self):
         py = create_tmp_test("")
         with python(py.name) as p:
@@ -3206,6 +3458,77 @@ exit(1)
                 os.close(master)
                 os.close(slave)
 
+    def test_selector_poller(self):
+        sh_module = sh._SelfWrapper__self_module
+        SelectorPoller = sh_module.SelectorPoller
+        READ, WRITE = sh_module.POLLER_EVENT_READ, sh_module.POLLER_EVENT_WRITE
+
+        read_fd, write_fd = os.pipe()
+        poller = SelectorPoller()
+        try:
+            poller.register_read(read_fd)
+            poller.register_write(write_fd)
+            # registering an fd twice merges the events instead of raising
+            poller.register_error(write_fd)
+            self.assertEqual(len(poller), 2)
+
+            # nothing to read yet, but the pipe has room to write
+            self.assertEqual(poller.poll(0), [(write_fd, WRITE)])
+
+            os.write(write_fd, b"x")
+            self.assertEqual(
+                sorted(poller.poll(0)), [(read_fd, READ), (write_fd, WRITE)]
+            )
+
+            poller.unregister(write_fd)
+            self.assertEqual(poller.poll(0), [(read_fd, READ)])
+            poller.unregister(read_fd)
+            self.assertFalse(poller)
+        finally:
+            poller.close()
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_selector_poller_closes_fd(self):
+        import gc
+
+        sh_module = sh._SelfWrapper__self_module
+        SelectorPoller = sh_module.SelectorPoller
+
+        def num_open_fds():
+            return len(os.listdir("/dev/fd"))
+
+        read_fd, write_fd = os.pipe()
+        # with the gc off, a leaked selector would keep its fd open
+        gc.disable()
+        try:
+            before = num_open_fds()
+            for _ in range(20):
+                poller = SelectorPoller()
+                poller.register_read(read_fd)
+                poller.poll(0)
+                poller.close()
+            self.assertEqual(num_open_fds(), before)
+
+            # and the same through real commands, which create a poller per
+            # io thread and per chunk read from a file
+            orig_poller = sh_module.Poller
+            sh_module.Poller = SelectorPoller
+            try:
+                with tempfile.TemporaryFile() as h:
+                    h.write(b"hello")
+                    before = num_open_fds()
+                    for _ in range(5):
+                        h.seek(0)
+                        self.assertEqual(sh.cat(_in=h), "hello")
+                    self.assertEqual(num_open_fds(), before)
+            finally:
+                sh_module.Poller = orig_poller
+        finally:
+            gc.enable()
+            os.close(read_fd)
+            os.close(write_fd)
+
     def test_args_deprecated(self):
         self.assertRaises(DeprecationWarning, sh.args, _env={})
 
@@ -3316,6 +3639,28 @@ print("字")
 
         self.assertEqual(sig, SignalException_SIGQUIT)
 
+    def test_exception_lookup_identity(self):
+        import sh
+
+        # however they're looked up, there's only ever one class per code
+        self.assertIs(sh.ErrorReturnCode_42, sh.ErrorReturnCode_42)
+        self.assertEqual(sh.ErrorReturnCode_42.exit_code, 42)
+        self.assertIs(
+            getattr(sh, f"SignalException_{signal.SIGQUIT}"),
+            sh.SignalException_SIGQUIT,
+        )
+
+    def test_module_attr_memoized(self):
+        import sh
+
+        sh.ErrorReturnCode_43
+        self.assertIn("ErrorReturnCode_43", vars(sh))
+        self.assertEqual(sh.ErrorReturnCode_43.exit_code, 43)
+
+        # commands are always resolved again
+        sh.ls
+        self.assertNotIn("ls", vars(sh))
+
     def test_change_log_message(self):
         py = create_tmp_test(
             """
@@ -3439,6 +3784,16 @@ class StreamBuffererTests(unittest.TestCase):
         self.assertEqual(b.process(b"\nthree\nfour"), [b"two\n", b"three\n"])
         self.assertEqual(b.flush(), b"four")
 
+    def test_newline_buffered_many_lines(self):
+        from sh import StreamBufferer
+
+        b = StreamBufferer(1)
+
+        lines = [b"line %d\n" % i for i in range(5000)]
+        self.assertEqual(b.process(b"".join(lines) + b"partial"), lines)
+        self.assertEqual(b.process(b" line\n"), [b"partial line\n"])
+        self.assertEqual(b.flush(), b"")
+
     def test_chunk_buffered(self):
         from sh import StreamBufferer
 